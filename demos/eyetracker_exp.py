@@ -1,3 +1,4 @@
+import argparse
 from exptools2.core import PylinkEyetrackerSession
 from exptools2.core import Trial
 from psychopy.visual import TextStim
@@ -5,52 +6,80 @@ from psychopy.visual import TextStim
 
 class TestTrial(Trial):
     """ Simple trial with text (trial x) and fixation. """
-    def __init__(self, session, trial_nr, phase_durations, txt=None, **kwargs):
-        super().__init__(session, trial_nr, phase_durations, **kwargs)
-        self.txt = TextStim(self.session.win, txt) 
+    __slots__ = ('_txt_str',)
+
+    def __init__(self, session, trial_nr, phase_durations, txt=None,
+                 parameters=None, verbose=True, timing='seconds'):
+        super().__init__(session, trial_nr, phase_durations, parameters=parameters,
+                         verbose=verbose, timing=timing)
+        self._txt_str = txt
 
     def draw(self):
         """ Draws stimuli """
         if self.phase == 0:
-            self.txt.draw()
+            txt = self.session._trial_text
+            if txt.text != self._txt_str:  # only re-layout on change
+                txt.text = self._txt_str
+            txt.draw()
         else:
             self.session.default_fix.draw()
 
 class TestEyetrackerSession(PylinkEyetrackerSession):
     """ Simple session with x trials. """
 
-    def __init__(self, output_str, output_dir=None, settings_file=None, n_trials=10, eyetracker_on=True):
+    def __init__(self, output_str, output_dir=None, settings_file=None, n_trials=10, eyetracker_on=True,
+                 reuse_calibration=False):
         """ Initializes TestSession object. """
         self.n_trials = n_trials
+        self.reuse_calibration = reuse_calibration
         super().__init__(output_str, output_dir=output_dir,
                          settings_file=settings_file, eyetracker_on=eyetracker_on)
+        self._trial_text = TextStim(self.win, '')  # shared by all trials
+
+    def create_trials(self, durations=(.5, .5), timing='frames'):
+        if timing == 'frames':  # durations are given in seconds
+            durations = tuple(int(round(d * self.actual_framerate)) for d in durations)
+
+        # generator: each trial is only created when the run loop gets to it
+        self.trials = (
+            TestTrial(session=self,
+                      trial_nr=trial_nr,
+                      phase_durations=durations,
+                      txt=f'Trial {trial_nr}',
+                      verbose=False,
+                      timing=timing)
+            for trial_nr in range(self.n_trials)
+        )
+        self.trials_run = []  # the generator above is not kept
 
-    def create_trials(self, durations=(.5, .5), timing='seconds'):
-        self.trials = []
-        for trial_nr in range(self.n_trials):
-            self.trials.append(
-                TestTrial(session=self,
-                          trial_nr=trial_nr,
-                          phase_durations=durations,
-                          txt='Trial %i' % trial_nr,
-                          verbose=False,
-                          timing=timing)
-            )
+        # pre-warm the label texture (no flip)
+        self._trial_text.text = 'Trial 0'
+        self._trial_text.draw()
+        self.win.clearBuffer()
 
     def run(self):
         """ Runs experiment. """
 
-        self.calibrate_eyetracker()
+        if not self.reuse_calibration:  # host PC keeps the last calibration
+            self.calibrate_eyetracker()
+
         self.start_experiment()
         self.start_recording_eyetracker()
         for trial in self.trials:
             trial.run()
+            self.trials_run.append(trial)
 
         self.close()  # contains tracker.stopRecording()
 
 
 if __name__ == '__main__':
 
-    session = TestEyetrackerSession('sub-01', eyetracker_on=True, n_trials=10)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reuse-calibration', action='store_true',
+                        help='Skip calibration and use the one from the previous run')
+    args = parser.parse_args()
+
+    session = TestEyetrackerSession('sub-01', eyetracker_on=True, n_trials=10,
+                                    reuse_calibration=args.reuse_calibration)
     session.create_trials()
     session.run()
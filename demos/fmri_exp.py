@@ -14,6 +14,7 @@ class TestFMRISession(TestSession):
 
         for trial in self.trials:
             trial.run()
+            self.trials_run.append(trial)
             print(trial.last_resp)
 
         self.close()
@@ -22,6 +23,6 @@ class TestFMRISession(TestSession):
 if __name__ == '__main__':
 
     session = TestFMRISession('sub-01', n_trials=10)
-    session.create_trials(durations=(0.5, .5), timing='seconds')
+    session.create_trials(durations=(0.5, .5))
     session.run()
     session.quit()
@@ -1,4 +1,7 @@
+import queue
+import threading
 import os.path as op
+import numpy as np
 from exptools2.core import Session
 from exptools2.core import Trial
 from psychopy.visual import TextStim
@@ -6,14 +9,21 @@ from exptools2 import utils
 
 class TestTrial(Trial):
     """ Simple trial with text (trial x) and fixation. """
-    def __init__(self, session, trial_nr, phase_durations, txt=None, **kwargs):
-        super().__init__(session, trial_nr, phase_durations, **kwargs)
-        self.txt = TextStim(self.session.win, txt) 
+    __slots__ = ('_txt_str',)
+
+    def __init__(self, session, trial_nr, phase_durations, txt=None,
+                 parameters=None, verbose=True, timing='seconds'):
+        super().__init__(session, trial_nr, phase_durations, parameters=parameters,
+                         verbose=verbose, timing=timing)
+        self._txt_str = txt
 
     def draw(self):
         """ Draws stimuli """
         if self.phase == 0:
-            self.txt.draw()
+            txt = self.session._trial_text
+            if txt.text != self._txt_str:  # only re-layout on change
+                txt.text = self._txt_str
+            txt.draw()
         else:
             self.session.default_fix.draw()
 
@@ -24,25 +34,68 @@ class TestSession(Session):
         """ Initializes TestSession object. """
         self.n_trials = n_trials
         super().__init__(output_str, output_dir=None, settings_file=settings_file)
+        self._trial_text = TextStim(self.win, '')  # shared by all trials
+
+    def create_trials(self, durations=(.5, .5), timing='frames'):
+        """ Creates trials in a background thread while earlier trials
+        are running; only a few trials are held in memory at a time. """
+        if timing == 'frames':  # durations are given in seconds
+            durations = tuple(int(round(d * self.actual_framerate)) for d in durations)
+
+        # The design is kept as one row per trial; Trial objects are only
+        # created (from their row) when the producer gets to them
+        trial_nrs = np.arange(self.n_trials)
+        self.design = np.zeros(self.n_trials, dtype=[
+            ('trial_nr', 'i8'),
+            ('durations', 'i8' if timing == 'frames' else 'f8', len(durations)),
+            ('trial_type', 'U4')
+        ])
+        self.design['trial_nr'] = trial_nrs
+        self.design['durations'] = durations
+        self.design['trial_type'] = np.where(trial_nrs % 2 == 0, 'even', 'odd')
+
+        trial_queue = queue.Queue(maxsize=2)
+        producer_error = []
+
+        def produce():
+            try:
+                for row in self.design:
+                    trial_nr = int(row['trial_nr'])
+                    trial_queue.put(
+                        TestTrial(session=self,
+                                  trial_nr=trial_nr,
+                                  phase_durations=row['durations'].tolist(),
+                                  txt=f'Trial {trial_nr}',
+                                  parameters=dict(trial_type=str(row['trial_type'])),
+                                  verbose=True,
+                                  timing=timing)
+                    )
+            except Exception as e:
+                producer_error.append(e)
+            finally:
+                trial_queue.put(None)  # no more trials
+
+        def consume():
+            yield from iter(trial_queue.get, None)
+            if producer_error:  # re-raise in the main thread
+                raise producer_error[0]
+
+        threading.Thread(target=produce, daemon=True).start()
+        self.trials = consume()
+        self.trials_run = []  # the (one-shot) iterator above is not kept
 
-    def create_trials(self, durations=(.5, .5), timing='seconds'):
-        self.trials = []
-        for trial_nr in range(self.n_trials):
-            self.trials.append(
-                TestTrial(session=self,
-                          trial_nr=trial_nr,
-                          phase_durations=durations,
-                          txt='Trial %i' % trial_nr,
-                          parameters=dict(trial_type='even' if trial_nr % 2 == 0 else 'odd'),
-                          verbose=True,
-                          timing=timing)
-            )
+        # Draw the label once (without flipping) so its texture is uploaded
+        # before the experiment starts rather than on the first frame
+        self._trial_text.text = 'Trial 0'
+        self._trial_text.draw()
+        self.win.clearBuffer()
 
     def run(self):
         """ Runs experiment. """
         self.start_experiment()
         for trial in self.trials:
-            trial.run()            
+            trial.run()
+            self.trials_run.append(trial)
 
         self.close()
 
@@ -51,7 +104,7 @@ if __name__ == '__main__':
 
     settings = op.join(op.dirname(__file__), 'settings.yml')
     session = TestSession('sub-01', n_trials=100, settings_file=settings)
-    session.create_trials(durations=(.25, .25), timing='seconds')
-    #session.create_trials(durations=(3, 3), timing='frames')
+    session.create_trials(durations=(.25, .25))
+    #session.create_trials(durations=(.25, .25), timing='seconds')
     session.run()
-    session.quit()
\ No newline at end of file
+    session.quit()
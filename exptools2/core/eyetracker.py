@@ -1,14 +1,21 @@
+import gc
+import time
+import queue
+import atexit
+import functools
 import warnings
+import threading
 import os.path as op
 import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from psychopy import core
 from psychopy import misc
 from psychopy import event
-from psychopy.visual import TextStim, Circle
+from psychopy.visual import TextStim
 from psychopy import visual, sound
 from psychopy import logging
-from PIL import Image, ImageOps
+from PIL import Image
 from .session import Session
 from .trial import Trial
 
@@ -42,13 +49,31 @@ class PylinkEyetrackerSession(Session):
         tracker : Eyelink
             Pylink 'Eyelink' object
         display : PsychopyCustomDisplay
-            exptools2' PsychopyCustomDisplay object
+            exptools2' PsychopyCustomDisplay object (None until the
+            first calibration)
         """
         super().__init__(output_str, output_dir, settings_file)
         self.eyetracker_on = eyetracker_on
+        self._eye_thread = None  # see start_eye_poller
+        self._edf_future = None  # see close
+        self._gaze_buf = np.full(4, np.nan)  # see get_latest_gaze
+        self._msg_thread = None  # see send_message
+        # pylink makes no thread-safety guarantees, and the tracker is used
+        # from several threads (messages, eye poller, EDF transfer), so all
+        # calls to it should hold this lock (and check _tracker_closed, as
+        # the EDF transfer at close runs without it)
+        self._tracker_lock = threading.RLock()
+        self._tracker_closed = False
         self.et_settings = self.settings['eyetracker']  # for convenience
         self.tracker = self._create_tracker()
-        self.display = self._create_display()
+        if self.tracker is not None:  # bound once, called at every start/stop
+            self._start_rec = functools.partial(self.tracker.startRecording, 1, 1, 1, 1)
+            self._stop_rec = self.tracker.stopRecording
+            self._msg_queue = queue.Queue()
+            self._msg_thread = threading.Thread(target=self._send_messages, daemon=True)
+            self._msg_thread.start()
+
+        self.display = None  # created on first calibration
         self._set_options_tracker()
 
     def _create_tracker(self):
@@ -68,14 +93,23 @@ class PylinkEyetrackerSession(Session):
     def _set_options_tracker(self):
         """ Sets a bunch of options . """
 
-        if self.eyetracker_on:
-            for opt_name, opt_val in self.et_settings['options'].items():
-                cmd = f'{opt_name} = {opt_val}'
-                self.tracker.sendCommand(cmd)
-                core.wait(0.05)  # give it some time
+        options = self.et_settings.get('options')
+        if not self.eyetracker_on or not options:
+            return
+
+        # Send all options back-to-back and let the tracker settle
+        # once at the end, instead of waiting after every command
+        with self._tracker_lock:
+            for opt_name, opt_val in options.items():
+                self.tracker.sendCommand(f'{opt_name} = {opt_val}')
+
+        # give it some time (while servicing the link)
+        delay_ms = int(self.et_settings.get('command_delay', 0.05) * 1000)
+        if delay_ms > 0:
+            pylink.pumpDelay(delay_ms)
 
     def _create_display(self):
-        """ Creates a custom display upon initialization ."""
+        """ Creates a custom display (once, when calibrating). """
         
         if not self.eyetracker_on or not PYLINK_AVAILABLE:
             return None
@@ -91,37 +125,237 @@ class PylinkEyetrackerSession(Session):
         # Note: doTrackerSetup already calls
         # sendMessage("DISPLAY_COORDS" + win.size)
 		# sendCommand("screen_pixel_coords" + win.size)
-        self.tracker.doTrackerSetup(*self.win.size)
+
+        # The pylink callbacks draw with OpenGL, so they have to run in this
+        # (main) thread; instead, raise priority and pause garbage collection
+        # to avoid stutters of the calibration target
+        if self.display is None:
+            self.display = self._create_display()
+
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        core.rush(True)
+        try:
+            with self._tracker_lock:
+                self.tracker.doTrackerSetup(*self.win.size)
+        finally:
+            core.rush(False)
+            if gc_was_enabled:
+                gc.enable()
 
     def start_recording_eyetracker(self):
         """ Starts recording data. This should be called 
         *before* calling self.start_experiment()
         """
         if self.eyetracker_on:
-            self.tracker.startRecording(1, 1, 1, 1)
-            core.wait(0.05)  # start recording takes a while
+            with self._tracker_lock:
+                self._start_rec()
+                # Returns as soon as link samples arrive (at most 100 ms),
+                # instead of always waiting
+                self.tracker.waitForBlockStart(100, 1, 0)
+
+            # the onset is marked at the next (first) flip
+            self.win.callOnFlip(self.send_message, 'RECORDING_ONSET')
+
+    def send_message(self, msg):
+        """ Sends a message to the tracker (i.e., to the EDF file) from
+        a background thread, so that trials don't wait for the link. The
+        message is timestamped at the time of this call, not when it is
+        actually sent.
+
+        Parameters
+        ----------
+        msg : str
+            Message to send
+        """
+        if self._msg_thread is None:  # no tracker, or closed (link may be gone)
+            logging.warn(f"Eyetracker not available; dropped message '{msg}'")
+            return
+
+        self._msg_queue.put((core.getTime(), msg))
+
+    def send_command(self, cmd):
+        """ Sends a command to the tracker (in this thread).
+
+        Parameters
+        ----------
+        cmd : str
+            Command to send
+        """
+        with self._tracker_lock:
+            if self._tracker_closed:
+                logging.warn(f"Eyetracker closed; dropped command '{cmd}'")
+                return
+
+            self.tracker.sendCommand(cmd)
+
+    def _send_messages(self):
+        """ Loop run by the thread started in __init__ (see send_message);
+        stops when it gets None. """
+        while True:
+            item = self._msg_queue.get()
+            if item is None:
+                break
+
+            t, msg = item
+            # A leading number is the time (in ms) the message is backdated
+            delay_ms = int(round((core.getTime() - t) * 1000))
+            with self._tracker_lock:
+                self.tracker.sendMessage(f'{delay_ms} {msg}' if delay_ms > 0 else msg)
+
+    def _flush_messages(self):
+        """ Sends all queued messages and stops the message thread. """
+        if self._msg_thread is not None:
+            self._msg_queue.put(None)
+            self._msg_thread.join()
+            self._msg_thread = None
+
+    def start_eye_poller(self, buffer_size=8192):
+        """ Starts a background thread that polls the newest sample
+        from the tracker into a ring buffer, so that trials can read
+        the current gaze position without talking to the tracker
+        themselves (see get_latest_gaze). Should be called after
+        start_recording_eyetracker(); stopped by
+        stop_recording_eyetracker().
+
+        Parameters
+        ----------
+        buffer_size : int
+            Number of samples kept in the ring buffer
+        """
+        if not self.eyetracker_on or self._eye_thread is not None or self._tracker_closed:
+            return
+
+        # columns: tracker time (ms), gaze x, gaze y, pupil size
+        self._eye_buf = np.full((buffer_size, 4), np.nan)
+        self._eye_idx = 0
+        self._eye_polling = True
+        self._eye_thread = threading.Thread(target=self._eye_poll, daemon=True)
+        self._eye_thread.start()
+
+    def _eye_poll(self):
+        """ Polling loop run by the thread started in start_eye_poller. """
+        n = self._eye_buf.shape[0]
+        last_time = None
+        while self._eye_polling:
+            with self._tracker_lock:
+                sample = self.tracker.getNewestSample()
+            if sample is not None and sample.getTime() != last_time:
+                last_time = sample.getTime()
+                eye = _get_eye_data(sample)
+                gx, gy = eye.getGaze()
+                self._eye_buf[self._eye_idx % n] = (last_time, gx, gy, eye.getPupilSize())
+                self._eye_idx += 1
+
+            time.sleep(0.001)
+
+    def get_latest_gaze(self):
+        """ Returns the newest sample as an array with (time, x, y, pupil),
+        read from the eye poller's buffer if it runs, or else from the
+        tracker itself. To avoid allocations when called every frame, the
+        *same* array is filled in place and returned on every call, so copy
+        it if you need to keep the values. Contains NaNs if there is no
+        sample (yet), or no tracker. """
+        if self._eye_thread is not None and self._eye_idx > 0:
+            self._gaze_buf[:] = self._eye_buf[(self._eye_idx - 1) % self._eye_buf.shape[0]]
+            return self._gaze_buf
+
+        sample = None
+        if self.tracker is not None and self._eye_thread is None:
+            with self._tracker_lock:
+                if not self._tracker_closed:
+                    sample = self.tracker.getNewestSample()
+
+        if sample is None:
+            self._gaze_buf[:] = np.nan
+        else:
+            eye = _get_eye_data(sample)
+            gx, gy = eye.getGaze()
+            self._gaze_buf[:] = (sample.getTime(), gx, gy, eye.getPupilSize())
+
+        return self._gaze_buf
 
     def stop_recording_eyetracker(self):
         """ Stops recording data. """ 
-        if self.eyetracker_on:
-            core.wait(0.15)  # wait a bit
-            self.tracker.stopRecording()
+        if self._eye_thread is not None:  # stop eye poller
+            self._eye_polling = False
+            self._eye_thread.join()
+            self._eye_thread = None
+
+        if self.eyetracker_on and not self._tracker_closed:
+            pylink.pumpDelay(150)  # wait a bit (keeps receiving link data)
+            with self._tracker_lock:
+                self._stop_rec()
 
     def close(self):
-        """ Closes the session (including eyetracker stuff). """
+        """ Closes the session (including eyetracker stuff). The EDF
+        file is transferred in the background, unless 'sync_edf' is set
+        in the eyetracker settings; use wait_for_edf() if you need the
+        file on disk right away (it is always waited for at exit). """
+        # Base close first: it timestamps the end of the experiment on the
+        # final flip, which should not include the tracker teardown below
         super().close()
 
-        if self.eyetracker_on:
+        if self.eyetracker_on and self._edf_future is None:
+            self._flush_messages()  # should all end up in the EDF file
             self.stop_recording_eyetracker()
-            self.tracker.setOfflineMode()
-            core.wait(.5)
+            with self._tracker_lock:
+                self.tracker.setOfflineMode()
+                self.tracker.waitForModeReady(500)  # returns as soon as it's offline
+                # From here on, only the EDF transfer uses the tracker (without
+                # the lock, so that other calls don't wait for the transfer)
+                self._tracker_closed = True
             f_out = op.join(self.output_dir, self.output_str + '.edf')
-            self.tracker.receiveDataFile(self.edf_name, f_out)
-            self.tracker.close()
+
+            executor = ThreadPoolExecutor(max_workers=1)
+            self._edf_future = executor.submit(self._receive_edf, f_out)
+            executor.shutdown(wait=False)
+            atexit.register(self.wait_for_edf)
+
+        if self.et_settings.get('sync_edf', False):
+            self.wait_for_edf()
+
+    def _receive_edf(self, f_out):
+        """ Transfers the EDF file from the host PC and closes the link. """
+        self.tracker.receiveDataFile(self.edf_name, f_out)
+        self.tracker.close()
+
+    def wait_for_edf(self):
+        """ Blocks until the EDF transfer started by close() is done. """
+        if self._edf_future is not None:
+            self._edf_future.result()
+
+
+def _get_eye_data(sample):
+    """ Returns the sample data of the recorded eye (right if both). """
+    if sample.isRightSample():
+        return sample.getRightEye()
+
+    return sample.getLeftEye()
 
 
 if PYLINK_AVAILABLE:  # super ugly, but don't know an elegant fix atm
 
+    # psychopy key name -> (reusable) pylink KeyInput
+    _SPECIAL_KEYS = {
+        key: pylink.KeyInput(code, 0) for key, code in (
+            ("escape", pylink.ESC_KEY),
+            ("return", pylink.ENTER_KEY),
+            ("pageup", pylink.PAGE_UP),
+            ("pagedown", pylink.PAGE_DOWN),
+            ("up", pylink.CURS_UP),
+            ("down", pylink.CURS_DOWN),
+            ("left", pylink.CURS_LEFT),
+            ("right", pylink.CURS_RIGHT),
+        )
+    }
+    # printable characters map onto their ascii code
+    _PYLINK_KEYMAP = dict(
+        {chr(c): pylink.KeyInput(c, 0) for c in range(33, 127)}, **_SPECIAL_KEYS
+    )
+    # only these keys are read during calibration (see get_input_key)
+    _INPUT_KEYS = list(_PYLINK_KEYMAP)
+
     class PsychopyCustomDisplay(pylink.EyeLinkCustomDisplay):
         """ Custom display for Eyelink eyetracker.
         Modified from the 'pylinkwrapper' package by Nick DiQuattro
@@ -137,106 +371,92 @@ if PYLINK_AVAILABLE:  # super ugly, but don't know an elegant fix atm
             self.win = win
             self.settings = settings  # from session
             self.txtcol = -1
-            #self.__target_beep__ = sound.Sound(800, secs=.1)  # THIS WILL GIVE A SEGFAULT!
-            #self.__target_beep__done__ = sound.Sound(1200, secs=.1)  # THIS WILL GIVE A SEGFAULT!
-            #self.__target_beep__error__ = sound.Sound(400, secs=.1)  # THIS WILL GIVE A SEGFAULT!
+
+            # Beeps are off by default, as creating sounds segfaults with some
+            # audio backends; if on, they're created once here (not on first
+            # play) so that the first beep isn't delayed by opening the device
+            self._beeps = dict()
+            if self.settings['eyetracker'].get('beeps', False):
+                target, done, error = (sound.Sound(hz, secs=.1) for hz in (800, 1200, 400))
+                self._beeps = {
+                    pylink.DC_TARG_BEEP: target, pylink.CAL_TARG_BEEP: target,
+                    pylink.DC_GOOD_BEEP: done, pylink.CAL_GOOD_BEEP: done,
+                    pylink.DC_ERR_BEEP: error, pylink.CAL_ERR_BEEP: error
+                }
+
             self.backcolor = self.win.color
+            self._half_w, self._half_h = self.win.size[0] / 2, self.win.size[1] / 2
+            self._target_lut = dict()  # tracker (x, y) -> psychopy pos
 
             self.imgstim_size = None
             self.rgb_index_array = None
             self.eye_image = None
             self.imagetitlestim = None
+            self._dummy_txt = None  # see dummynote
 
             dot_size_pix = misc.deg2pix(self.settings['eyetracker'].get('dot_size'),
                                         self.win.monitor)
-            self.targetout = Circle(
-                self.win, pos=(0, 0), radius=dot_size_pix, fillColor='black',
-                units='pix', lineColor='black'
-            )
 
-            self.targetin = Circle(
-                self.win, pos=(0, 0), radius=3, fillColor=0,
-                lineColor=0, units='pix', opacity=0
+            # Calibration target (black dot), rasterized once into a texture
+            r = int(round(dot_size_pix))
+            yy, xx = np.ogrid[-r:r + 1, -r:r + 1]
+            dot = np.zeros((2 * r + 1, 2 * r + 1, 4), dtype=np.uint8)
+            dot[..., 3] = (xx ** 2 + yy ** 2 <= r ** 2) * 255  # alpha
+            self._target_sprite = visual.ImageStim(
+                self.win, image=Image.fromarray(dot, mode='RGBA'), pos=(0, 0),
+                size=dot.shape[:2], units='pix', interpolate=False
             )
-            win.flip()
 
-        def setup_cal_display(self):
-            txt = TextStim(
+            self._cal_txt = TextStim(
                 self.win, text="Please follow the dot. Try not to anticipate its movements.",
                 pos=(0, 100), color='black', units='pix'
             )
+            # Setup screen (instructions + centered target) never changes,
+            # so render it once into a single texture
+            self._cal_bg = visual.BufferImageStim(
+                self.win, stim=[self._cal_txt, self._target_sprite]
+            )
 
-            txt.draw()
-            self.targetout.draw()
+        def setup_cal_display(self):
+            self._cal_bg.draw()
             self.win.flip()
 
         def exit_cal_display(self):
             self.clear_cal_display()
 
         def clear_cal_display(self):
-            self.setup_cal_display()
+            # The back buffer is cleared after each flip, so this shows a
+            # blank screen; the instructions are only drawn on setup
+            self.win.flip()
 
         def erase_cal_target(self):
-            self.win.flip()
+            self.clear_cal_display()
 
         def draw_cal_target(self, x, y):
-            # Convert to psychopy coordinates
-            x = x - (self.win.size[0] / 2)
-            y = -(y - (self.win.size[1] / 2))
+            # Convert to psychopy coordinates (once per grid point)
+            lut, sprite = self._target_lut, self._target_sprite
+            pos = lut.get((x, y))
+            if pos is None:
+                pos = lut[(x, y)] = (x - self._half_w, self._half_h - y)
 
-            # Set calibration target position
-            self.targetout.pos = (x, y)
-            self.targetin.pos = (x, y)
+            sprite.pos = pos
 
             # Display
-            self.targetout.draw()
-            self.targetin.draw()
+            sprite.draw()
             self.win.flip()
 
         def alert_printf(self, msg):
             print("alert_printf %s" % msg)
 
         def play_beep(self, beepid):
-            if beepid == pylink.DC_TARG_BEEP or beepid == pylink.CAL_TARG_BEEP:
-                #self.__target_beep__.play()
-                pass
-            elif beepid == pylink.CAL_ERR_BEEP or beepid == pylink.DC_ERR_BEEP:
-                #self.__target_beep__error__.play()
-                pass
-            else:  # CAL_GOOD_BEEP or DC_GOOD_BEEP
-                #self.__target_beep__done__.play()
-                pass
+            beep = self._beeps.get(beepid)
+            if beep is not None:
+                beep.play()
 
         def get_input_key(self):
-                ky = []
-                v = event.getKeys()
-                for key in v:
-                    pylink_key = None
-                    if len(key) == 1:
-                        pylink_key = ord(key)
-                    elif key == "escape":
-                        pylink_key = pylink.ESC_KEY
-                    elif key == "return":
-                        pylink_key = pylink.ENTER_KEY
-                    elif key == "pageup":
-                        pylink_key = pylink.PAGE_UP
-                    elif key == "pagedown":
-                        pylink_key = pylink.PAGE_DOWN
-                    elif key == "up":
-                        pylink_key = pylink.CURS_UP
-                    elif key == "down":
-                        pylink_key = pylink.CURS_DOWN
-                    elif key == "left":
-                        pylink_key = pylink.CURS_LEFT
-                    elif key == "right":
-                        pylink_key = pylink.CURS_RIGHT
-                    else:
-                        print(f'Error! :{key} is not a used key.')
-                        return
-
-                    ky.append(pylink.KeyInput(pylink_key, 0))
-
-                return ky
+            keys = [_PYLINK_KEYMAP[key] for key in event.getKeys(keyList=_INPUT_KEYS)]
+            event.clearEvents('keyboard')  # don't let other keys pile up
+            return keys
 
         def record_abort_hide(self):
             pass
@@ -247,8 +467,11 @@ if PYLINK_AVAILABLE:  # super ugly, but don't know an elegant fix atm
                 self.eye_frame_size = (width, height)
                 self.clear_cal_display()
                 self.last_mouse_state = -1
-                if self.rgb_index_array is None:
-                    self.rgb_index_array = np.zeros((int(height/2), int(width/2)), dtype=np.uint8)
+                # Reuse the buffer, unless the camera image size changed
+                shape = (int(height/2), int(width/2))
+                if self.rgb_index_array is None or self.rgb_index_array.shape != shape:
+                    # no need to zero it, draw_image_line overwrites every line
+                    self.rgb_index_array = np.empty(shape, dtype=np.uint8)
 
         def exit_image_display(self):
             self.clear_cal_display()
@@ -259,36 +482,36 @@ if PYLINK_AVAILABLE:  # super ugly, but don't know an elegant fix atm
                 self.imagetitlestim = TextStim(
                     self.win,
                     text=text,
-                    pos=(0, self.win.size[1] / 2 - 15),
+                    pos=(0, self._half_h - 15),
                     height=28,
                     color=self.txtcol,
                     alignHoriz='center',
                     alignVert='top',
-                    wrapWidth=self.win.size[0] * .8,
-                    units='pix'
+                    wrapWidth=self._half_w * 1.6,
+                    units='pix',
+                    autoLog=False
                 )
-            else:
-                self.imagetitlestim.setText(text)
-
-        def exit_image_display(self):
-            self.clear_cal_display()
-
+            elif self.imagetitlestim.text != text:  # only re-layout on change
+                self.imagetitlestim.text = text
 
         def draw_image_line(self, width, line, totlines, buff):
-            # Get image info for each line of image
-            for i in range(width):
-                self.rgb_index_array[line - 1, i] = buff[i]
+            # Copy this line of the image into the buffer
+            self.rgb_index_array[line - 1, :width] = np.fromiter(buff, dtype=np.uint8, count=width)
 
             # Once all lines are collected turn into an image to display
             if line == totlines:
                 try:
-                    image = Image.fromarray(self.rgb_index_array,
-                                            mode='P')
-                    image.putpalette(self.rgb_pallete)
-                    image = ImageOps.fit(image, [640, 480])
+                    # Wraps the buffer without copying it (unlike fromarray)
+                    h, w = self.rgb_index_array.shape
+                    image = Image.frombuffer('P', (w, h), self.rgb_index_array,
+                                             'raw', 'P', 0, 1)
+                    image.putpalette(self._palette_bytes)
+                    # Scaled to 640x480 by OpenGL (nearest neighbour), not by PIL
                     if self.eye_image is None:
                         self.eye_image = visual.ImageStim(
-                            self.win, image)
+                            self.win, image, size=(640, 480), units='pix',
+                            interpolate=False
+                        )
                     else:
                         self.eye_image.setImage(image)
 
@@ -305,17 +528,20 @@ if PYLINK_AVAILABLE:  # super ugly, but don't know an elegant fix atm
         def set_image_palette(self, r, g, b):
             # This does something the other image functions need
             self.clear_cal_display()
-            sz = len(r)
-            self.rgb_pallete = np.zeros((sz, 3), dtype=np.uint8)
-            i = 0
-            while i < sz:
-                self.rgb_pallete[i:] = int(r[i]), int(g[i]), int(b[i])
-                i += 1
+            self.rgb_pallete = np.stack([
+                np.asarray(r, dtype=np.uint8),
+                np.asarray(g, dtype=np.uint8),
+                np.asarray(b, dtype=np.uint8)
+            ], axis=1)
+            self._palette_bytes = self.rgb_pallete.tobytes()  # as PIL wants it
 
         def dummynote(self):
             # Draw Text
-            visual.TextStim(self.win, text='Dummy Connection with EyeLink',
-                            color=self.txtcol).draw()
+            if self._dummy_txt is None:
+                self._dummy_txt = visual.TextStim(
+                    self.win, text='Dummy Connection with EyeLink', color=self.txtcol
+                )
+            self._dummy_txt.draw()
             self.win.flip()
 
             # Wait for key press
@@ -1,24 +1,48 @@
 import os
+import copy
+import math
 import yaml
+import functools
+import threading
 import collections
 import os.path as op
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from psychopy import core
 from psychopy.sound import Sound
 from psychopy.hardware.emulator import SyncGenerator
 from psychopy.visual import Window, TextStim
-from psychopy.event import waitKeys, Mouse
+from psychopy.event import getKeys, clearEvents, Mouse
+from psychopy.hardware.keyboard import Keyboard
 from psychopy.monitors import Monitor
 from psychopy import logging
 from psychopy import prefs as psychopy_prefs
 from ..stimuli import create_circle_fixation
 
+try:  # LibYAML-based loader/dumper are much faster, but not always available
+    from yaml import CSafeLoader as _YamlLoader, CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader, SafeDumper as _YamlDumper
+
+
+# Logged events that are not phases (and thus have no duration)
+_NONRESP_EVENT_TYPES = np.array(["response", "trigger", "pulse"], dtype=object)
+
 
 class Session:
     """Base Session class"""
 
+    # Columns that come first in the events file (followed by any parameters)
+    _LOG_COLUMNS = ["trial_nr", "onset", "event_type", "phase", "response", "nr_frames"]
+    # Types of the columns set by exptools2 (the others are inferred); nr_frames
+    # is a nullable int, as responses have no frame count
+    _LOG_DTYPES = {
+        "onset": "float64",
+        "event_type": "object",
+        "phase": "int64",
+        "response": "object",
+    }
+
     def __init__(self, output_str, output_dir=None, settings_file=None):
         """Initializes base Session class.
 
@@ -49,8 +73,14 @@ class Session:
             Current window
         default_fix : TextStim
             Default fixation stim (a TextStim with '+')
+        global_log : pandas DataFrame
+            Log with onsets of phases and responses (see the global_log
+            property)
         actual_framerate : float
             Estimated framerate of monitor
+        keyboard : psychopy Keyboard
+            Keyboard device, read directly (not through the window's event
+            queue); key times are relative to clock. See get_keys
         """
         self.output_str = output_str
         self.output_dir = (
@@ -62,29 +92,28 @@ class Session:
         self.exp_start = None
         self.exp_stop = None
         self.current_trial = None
-        self.global_log = pd.DataFrame(
-            columns=[
-                "trial_nr",
-                "onset",
-                "event_type",
-                "phase",
-                "response",
-                "nr_frames",
-            ]
-        )
+        self._log_rows = []  # new rows (dicts), see global_log
+        self._log_df = None
         self.nr_frames = 0  # keeps track of nr of nr of frame flips
         self.first_trial = True
         self.closed = False
+        self.eyetracker_on = False  # set by eyetracker sessions
+        self.tracker = None
+        self._display_text_stims = dict()  # kwargs -> TextStim, see display_text
+        self._pending_keys = []  # (key, onset) tuples, see start_experiment
+        self._plot_thread = None  # see close
 
         # Initialize
         self.settings = self._load_settings()
+        self._mri_sync_key = self.settings["mri"].get("sync", "t")
         self.monitor = self._create_monitor()
         self.win = self._create_window()
-        self.width_deg = 2 * np.degrees(
-            np.arctan(self.monitor.getWidth() / self.monitor.getDistance())
+        self.width_deg = 2 * math.degrees(
+            math.atan(self.monitor.getWidth() / self.monitor.getDistance())
         )
         self.pix_per_deg = self.win.size[0] / self.width_deg
         self.mouse = Mouse(**self.settings["mouse"])
+        self.keyboard = Keyboard(clock=self.clock)
         self.logfile = self._create_logfile()
         self.default_fix = create_circle_fixation(
             self.win, radius=0.075, color=(1, 1, 1)
@@ -92,13 +121,36 @@ class Session:
         self.mri_trigger = None  # is set below
         self.mri_simulator = self._setup_mri()
 
+    @property
+    def global_log(self):
+        """DataFrame with the logged events. Trials append their rows to a
+        plain list (cheap to do every frame), which is only added to the
+        DataFrame when it is accessed, so reading or editing the log
+        (e.g., with .loc) during the experiment still works."""
+        if self._log_rows:
+            rows = pd.DataFrame(self._log_rows)
+            self._log_rows = []
+            if self._log_df is None or self._log_df.empty:
+                self._log_df = rows
+            else:
+                self._log_df = pd.concat([self._log_df, rows], ignore_index=True)
+        elif self._log_df is None:
+            self._log_df = pd.DataFrame(columns=self._LOG_COLUMNS)
+
+        return self._log_df
+
+    @global_log.setter
+    def global_log(self, log):
+        self._log_rows = []
+        self._log_df = log
+
     def _load_settings(self):
         """Loads settings and sets preferences."""
         default_settings_path = op.join(
             op.dirname(op.dirname(__file__)), "data", "default_settings.yml"
         )
-        with open(default_settings_path, "r", encoding="utf8") as f_in:
-            default_settings = yaml.safe_load(f_in)
+        # Copy, as the cached defaults must not be changed by the merge below
+        default_settings = copy.deepcopy(_read_settings_file(default_settings_path))
 
         if self.settings_file is None:
             settings = default_settings
@@ -108,7 +160,7 @@ class Session:
                 raise IOError(f"Settings-file {self.settings_file} does not exist!")
 
             with open(self.settings_file, "r", encoding="utf8") as f_in:
-                user_settings = yaml.safe_load(f_in)
+                user_settings = yaml.load(f_in, Loader=_YamlLoader)
 
             # Update (and potentially overwrite) default settings
             _merge_settings(default_settings, user_settings)
@@ -119,8 +171,12 @@ class Session:
             os.makedirs(self.output_dir)
 
         settings_out = op.join(self.output_dir, self.output_str + "_expsettings.yml")
-        with open(settings_out, "w") as f_out:  # write settings to disk
-            yaml.dump(settings, f_out, indent=4, default_flow_style=False)
+        settings_str = yaml.dump(
+            settings, Dumper=_YamlDumper, indent=4, default_flow_style=False
+        )
+        if not _file_has_content(settings_out, settings_str):
+            with open(settings_out, "w") as f_out:  # write settings to disk
+                f_out.write(settings_str)
 
         exp_prefs = settings["preferences"]  # set preferences globally
         for preftype, these_settings in exp_prefs.items():
@@ -147,6 +203,7 @@ class Session:
             logging.warn("framerate not measured, substituting 60 by default")
             self.actual_framerate = 60.0
         t_per_frame = 1.0 / self.actual_framerate
+        self._frame_period = t_per_frame  # used by Trial.run
 
         logging.warn(
             f"Actual framerate: {self.actual_framerate:.5f} "
@@ -187,6 +244,10 @@ class Session:
         self.clock.reset()  # resets global clock
         self.timer.reset()  # phase-timer
 
+        # Drop keys pressed before the start (e.g., to end instructions), so
+        # that the first trial doesn't log them with a negative onset
+        self._clear_keys()
+
         if self.mri_simulator is not None:
             self.mri_simulator.start()
 
@@ -200,12 +261,26 @@ class Session:
                 self.default_fix.draw()
                 self.win.flip()
 
+            # Poll the keyboard device directly, as the clock is reset right
+            # after the last trigger (any latency here shifts all onsets)
+            sync = self._mri_sync_key
             while n_triggers < wait_n_triggers:
-                waitKeys(keyList=[self.settings["mri"].get("sync", "t")])
-                n_triggers += 1
-                msg = f"\tOnset trigger {n_triggers}: {self.clock.getTime(): .5f}"
-                msg = msg + "\n" if n_triggers == wait_n_triggers else msg
-                print(msg)
+                triggers = self.get_keys([sync])
+                if not triggers:  # yield the CPU (~1 ms) instead of spinning
+                    core.wait(0.001, hogCPUperiod=0)
+                    continue
+
+                # Handles all triggers that came in since the last poll at once
+                for i, _ in enumerate(triggers):
+                    n_triggers += 1
+                    msg = f"\tOnset trigger {n_triggers}: {self.clock.getTime(): .5f}"
+                    msg = msg + "\n" if n_triggers == wait_n_triggers else msg
+                    print(msg)
+                    if n_triggers == wait_n_triggers:
+                        # Later triggers from the same poll are real pulses;
+                        # leave them for the first trial to log
+                        self._pending_keys = triggers[i + 1:]
+                        break
 
             self.timer.reset()
 
@@ -232,16 +307,92 @@ class Session:
         if keys is not None and duration is not None:
             raise ValueError("Cannot set both 'keys' and 'duration'!")
 
-        stim = TextStim(self.win, text=text, **kwargs)
+        # One stim per set of kwargs; only its text is updated on later calls
+        # (kwargs may contain lists, so they're keyed by their repr)
+        key = repr(sorted(kwargs.items()))
+        stim = self._display_text_stims.get(key)
+        if stim is None:
+            stim = TextStim(self.win, text=text, **kwargs)
+            self._display_text_stims[key] = stim
+        elif stim.text != text:
+            stim.text = text
+
         stim.draw()
         self.win.flip()
 
         if keys is not None:
-            waitKeys(keyList=keys)
+            # Read through get_keys (like the trials), so that the key
+            # isn't left in the keyboard's buffer for the first trial
+            keys = [keys] if isinstance(keys, str) else list(keys)
+            self._clear_keys()
+            while not self.get_keys(keys):
+                core.wait(0.001, hogCPUperiod=0)
 
         if duration is not None:
             core.wait(duration)
 
+    def get_keys(self, key_list=None):
+        """Returns the keys pressed since the last call, read from the
+        keyboard device (with hardware timestamps where available). When
+        the MRI simulator runs, psychopy's event queue is read instead, as
+        that's where its (emulated) triggers end up. Responses and triggers
+        always come from the same source; the other one is cleared on each
+        call (which also pumps the window's events), so that it doesn't
+        keep growing and old keys don't show up if the source changes.
+        Triggers that came in after the last one start_experiment waited
+        for are returned first.
+
+        parameters
+        ----------
+        key_list : list[str] (or None)
+            Only return (and clear) these keys; all keys if None
+
+        returns
+        -------
+        keys : list[tuple]
+            List of (key name, onset) tuples, with onsets relative to clock
+        """
+        pending = []
+        if self._pending_keys:  # left over from start_experiment
+            pending = [k for k in self._pending_keys if key_list is None or k[0] in key_list]
+            self._pending_keys = [k for k in self._pending_keys if k not in pending]
+
+        if self.mri_simulator is not None:
+            self.keyboard.clearEvents()
+            return pending + getKeys(keyList=key_list, timeStamped=self.clock)
+
+        keys = self.keyboard.getKeys(key_list, waitRelease=False, clear=True)
+        clearEvents("keyboard")
+        return pending + [(key.name, key.rt) for key in keys]
+
+    def send_message(self, msg):
+        """Sends a message to the eyetracker (if any). Eyetracker sessions
+        may override this (e.g., to send it from another thread).
+
+        parameters
+        ----------
+        msg : str
+            Message to send
+        """
+        self.tracker.sendMessage(msg)
+
+    def send_command(self, cmd):
+        """Sends a command to the eyetracker (if any); see send_message.
+
+        parameters
+        ----------
+        cmd : str
+            Command to send
+        """
+        self.tracker.sendCommand(cmd)
+
+    def _clear_keys(self):
+        """Clears all pending keys (of both the keyboard device and
+        psychopy's event queue, see get_keys)."""
+        self._pending_keys = []
+        self.keyboard.clearEvents()
+        clearEvents("keyboard")
+
     def close(self):
         """'Closes' experiment. Should always be called, even when
         experiment is quit manually (saves onsets to file)."""
@@ -255,48 +406,64 @@ class Session:
 
         print(f"\nDuration experiment: {self.exp_stop:.3f}\n")
 
-        if not op.isdir(self.output_dir):
-            os.makedirs(self.output_dir)
-
-        self.global_log = pd.DataFrame(self.global_log).set_index("trial_nr")
+        global_log = self.global_log
+        columns = self._LOG_COLUMNS + [
+            col for col in global_log.columns if col not in self._LOG_COLUMNS
+        ]
+        self.global_log = (
+            global_log.reindex(columns=columns)
+            .astype(self._LOG_DTYPES)
+            .set_index("trial_nr")
+        )
         self.global_log["onset_abs"] = self.global_log["onset"] + self.exp_start
 
-        # Only non-responses have a duration
-        nonresp_idx = ~self.global_log.event_type.isin(["response", "trigger", "pulse"])
-        last_phase_onset = self.global_log.loc[nonresp_idx, "onset"].iloc[-1]
-        dur_last_phase = self.exp_stop - last_phase_onset
-        durations = np.append(
-            self.global_log.loc[nonresp_idx, "onset"].diff().values[1:], dur_last_phase
+        # Only non-responses have a duration (computed on plain arrays,
+        # to avoid creating intermediate Series)
+        nonresp_idx = ~np.isin(
+            self.global_log["event_type"].to_numpy(), _NONRESP_EVENT_TYPES
         )
+        onsets = self.global_log["onset"].to_numpy(dtype=float)[nonresp_idx]
+        durations = np.empty_like(onsets)
+        durations[:-1] = np.diff(onsets)
+        durations[-1] = self.exp_stop - onsets[-1]
         self.global_log.loc[nonresp_idx, "duration"] = durations
 
-        # Same for nr frames
-        nr_frames = np.append(
-            self.global_log.loc[nonresp_idx, "nr_frames"].values[1:], self.nr_frames
-        )
-        self.global_log.loc[nonresp_idx, "nr_frames"] = nr_frames.astype(int)
+        # Same for nr frames (counted until the next phase starts)
+        nr_frames = np.empty(onsets.size, dtype=int)
+        nr_frames[:-1] = self.global_log["nr_frames"].to_numpy()[nonresp_idx][1:]
+        nr_frames[-1] = self.nr_frames
+        self.global_log.loc[nonresp_idx, "nr_frames"] = nr_frames
+        self.global_log["nr_frames"] = self.global_log["nr_frames"].astype("Int64")
 
         # Round for readability and save to disk
         self.global_log = self.global_log.round(
             {"onset": 5, "onset_abs": 5, "duration": 5}
         )
-        f_out = op.join(self.output_dir, self.output_str + "_events.tsv")
-        self.global_log.to_csv(f_out, sep="\t", index=True)
-
-        # Create figure with frametimes (to check for dropped frames)
-        fig, ax = plt.subplots(figsize=(15, 5))
-        ax.plot(self.win.frameIntervals)
-        ax.axhline(1.0 / self.actual_framerate, c="r")
-        ax.axhline(
-            1.0 / self.actual_framerate + 1.0 / self.actual_framerate, c="r", ls="--"
-        )
-        ax.set(
-            xlim=(0, len(self.win.frameIntervals) + 1),
-            xlabel="Frame nr",
-            ylabel="Interval (sec.)",
-            ylim=(-0.01, 0.125),
+        events_format = self.settings.get("output", {}).get("events_format", "tsv")
+        saved = False
+        if events_format == "parquet":  # needs pyarrow or fastparquet
+            f_out = op.join(self.output_dir, self.output_str + "_events.parquet")
+            try:
+                _to_parquet(self.global_log, f_out)
+                saved = True
+            except Exception as err:  # don't lose the log; save as tsv instead
+                logging.warn(f"Could not save events as parquet ({err}); saving tsv")
+
+        if not saved:
+            f_out = op.join(self.output_dir, self.output_str + "_events.tsv")
+            self.global_log.to_csv(f_out, sep="\t", index=True)
+
+        # Create figure with frametimes (to check for dropped frames); this
+        # is done in the background, so it doesn't hold up closing the window
+        self._plot_thread = threading.Thread(
+            target=_plot_frame_intervals,
+            args=(
+                list(self.win.frameIntervals),
+                self.actual_framerate,
+                op.join(self.output_dir, self.output_str + "_frames.pdf"),
+            ),
         )
-        fig.savefig(op.join(self.output_dir, self.output_str + "_frames.pdf"))
+        self._plot_thread.start()
 
         if self.mri_simulator is not None:
             self.mri_simulator.stop()
@@ -310,14 +477,68 @@ class Session:
         if not self.closed:
             self.close()
 
+        if self._plot_thread is not None:  # make sure the figure is saved
+            self._plot_thread.join()
+
         core.quit()
 
 
+@functools.lru_cache(maxsize=None)
+def _read_settings_file(path):
+    """Reads a yaml settings file; cached, so that the (package) default
+    settings are parsed only once per process. Don't modify the result."""
+    with open(path, "r", encoding="utf8") as f_in:
+        return yaml.load(f_in, Loader=_YamlLoader)
+
+
+def _file_has_content(path, content):
+    """Checks whether the (text) file at path exists and contains content."""
+    if not op.isfile(path):
+        return False
+
+    with open(path, "r") as f_in:
+        return f_in.read() == content
+
+
+def _to_parquet(df, f_out):
+    """Saves df as parquet. Object columns may mix types (e.g., list
+    parameters are logged as strings for phases but as is for responses),
+    which parquet doesn't support, so their (non-missing) values are
+    saved as strings."""
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+
+    df.to_parquet(f_out, index=True)
+
+
+def _plot_frame_intervals(intervals, framerate, f_out):
+    """Plots the frame intervals (and the expected interval) to f_out.
+    Uses a plain matplotlib Figure (no pyplot), so that it can run outside
+    the main thread; matplotlib is only imported here, as it's slow to import.
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(15, 5))
+    ax = fig.subplots()
+    ax.plot(intervals)
+    ax.axhline(1.0 / framerate, c="r")
+    ax.axhline(1.0 / framerate + 1.0 / framerate, c="r", ls="--")
+    ax.set(
+        xlim=(0, len(intervals) + 1),
+        xlabel="Frame nr",
+        ylabel="Interval (sec.)",
+        ylim=(-0.01, 0.125),
+    )
+    fig.savefig(f_out)
+
+
 def _merge_settings(default, user):
-    """Recursive dict merge. Inspired by dict.update(), instead of
-    updating only top-level keys, dict_merge recurses down into dicts nested
+    """Nested dict merge. Inspired by dict.update(), instead of
+    updating only top-level keys, dict_merge goes down into dicts nested
     to an arbitrary depth, updating keys. The merge_dct is merged into
     Adapted from https://gist.github.com/angstwad/bf22d1822c38a92ec0a9.
+    Uses a stack instead of recursion (so any depth is fine).
 
     Parameters
     ----------
@@ -330,12 +551,15 @@ def _merge_settings(default, user):
     -------
     None
     """
-    for k, v in user.items():
-        if (
-            k in default
-            and isinstance(default[k], dict)
-            and isinstance(user[k], collections.abc.Mapping)
-        ):
-            _merge_settings(default[k], user[k])
-        else:
-            default[k] = user[k]
+    stack = [(default, user)]
+    while stack:
+        default, user = stack.pop()
+        for k, v in user.items():
+            if (
+                k in default
+                and isinstance(default[k], dict)
+                and isinstance(v, collections.abc.Mapping)
+            ):
+                stack.append((default[k], v))
+            else:
+                default[k] = v
@@ -1,7 +1,4 @@
 import numpy as np
-import pandas as pd
-from psychopy import core
-from psychopy import event
 from psychopy import logging
 
 # TODO:
@@ -33,6 +30,10 @@ class Trial:
             The "units" of the phase durations. Default is 'seconds', where we
             assume the phase-durations are in seconds. The other option is
             'frames', where the phase-"duration" refers to the number of frames.
+            With 'seconds', the timer is checked on every frame, unless
+            'count_frames_seconds_timing' is set in the 'trial' settings (then
+            each phase shows the number of frames that fit in its remaining
+            time).
         load_next_during_phase : int (or None)
             If not None, the next trial will be loaded during this phase
         verbose : bool
@@ -53,6 +54,10 @@ class Trial:
         self.session = session
         self.trial_nr = trial_nr
         self.phase_durations = list(phase_durations)
+        # array copy used by run (the first phase may be shortened there)
+        self._phase_durations_arr = np.array(
+            phase_durations, dtype=float if timing == 'seconds' else None
+        )
         self.phase_names = ['stim'] * len(phase_durations) if phase_names is None else phase_names
         self.parameters = dict() if parameters is None else parameters
         self.timing = timing
@@ -67,13 +72,7 @@ class Trial:
         self.phase = 0
         self.last_resp = None
         self.last_resp_onset = None
-        if hasattr(self.session, 'tracker'):
-            if self.session.eyetracker_on:
-                self.eyetracker_on = True
-            else:
-                self.eyetracker_on = False
-        else:
-            self.eyetracker_on = False
+        self.eyetracker_on = getattr(self.session, 'eyetracker_on', False)
 
         self._check_params()
 
@@ -91,7 +90,7 @@ class Trial:
             raise ValueError("Please set timing to one of %s" % (TIMING_OPTS,))
 
         if self.timing == 'frames':
-            if not all([isinstance(dur, int) for dur in self.phase_durations]):
+            if not np.issubdtype(self._phase_durations_arr.dtype, np.integer):
                 raise ValueError("Durations should be integers when timing "
                                  "is set to 'frames'!")
 
@@ -130,23 +129,26 @@ class Trial:
 
         if self.eyetracker_on:  # send msg to eyetracker
             msg = f'start_type-stim_trial-{self.trial_nr}_phase-{phase}'
-            self.session.tracker.sendMessage(msg)
+            self.session.send_message(msg)
             # Should be log more to the eyetracker? Like 'parameters'?
 
         # add to global log
-        idx = self.session.global_log.shape[0]
-        self.session.global_log.loc[idx, 'onset'] = onset
-        self.session.global_log.loc[idx, 'trial_nr'] = self.trial_nr
-        self.session.global_log.loc[idx, 'event_type'] = self.phase_names[phase]
-        self.session.global_log.loc[idx, 'phase'] = phase
-        self.session.global_log.loc[idx, 'nr_frames'] = self.session.nr_frames
+        row = {
+            'onset': onset,
+            'trial_nr': self.trial_nr,
+            'event_type': self.phase_names[phase],
+            'phase': phase,
+            'nr_frames': self.session.nr_frames
+        }
 
         for param, val in self.parameters.items():  # add parameters to log
             if type(val) == np.ndarray or type(val) == list:
                 for i, x in enumerate(val):
-                    self.session.global_log.loc[idx, param+'_%4i'%i] = str(x) 
+                    row[param+'_%4i'%i] = str(x) 
             else:       
-                self.session.global_log.loc[idx, param] = val
+                row[param] = val
+
+        self.session._log_rows.append(row)
 
         # add to trial_log
         #idx = self.trial_log.shape[0]
@@ -165,7 +167,7 @@ class Trial:
 
     def get_events(self):
         """ Logs responses/triggers """
-        events = event.getKeys(timeStamped=self.session.clock)
+        events = self.session.get_keys()
         if events:
             if 'q' in [ev[0] for ev in events]:  # specific key in settings?
                 self.session.close()
@@ -178,25 +180,26 @@ class Trial:
                 else:
                     event_type = 'response'
 
-                idx = self.session.global_log.shape[0]
-                self.session.global_log.loc[idx, 'trial_nr'] = self.trial_nr
-                self.session.global_log.loc[idx, 'onset'] = t
-                self.session.global_log.loc[idx, 'event_type'] = event_type
-                self.session.global_log.loc[idx, 'phase'] = self.phase
-                self.session.global_log.loc[idx, 'response'] = key
+                row = {
+                    'trial_nr': self.trial_nr,
+                    'onset': t,
+                    'event_type': event_type,
+                    'phase': self.phase,
+                    'response': key
+                }
 
-                # for param, val in self.parameters.items():
-                    # self.session.global_log.loc[idx, param] = val
                 for param, val in self.parameters.items():  # add parameters to log
                     if type(val) == np.ndarray or type(val) == list:
                         for i, x in enumerate(val):
-                            self.session.global_log.loc[idx, param+'_%4i'%i] = x 
+                            row[param+'_%4i'%i] = x 
                     else:       
-                        self.session.global_log.loc[idx, param] = val
+                        row[param] = val
+
+                self.session._log_rows.append(row)
 
                 if self.eyetracker_on:  # send msg to eyetracker
                     msg = f'start_type-{event_type}_trial-{self.trial_nr}_phase-{self.phase}_key-{key}_time-{t}'
-                    self.session.tracker.sendMessage(msg)
+                    self.session.send_message(msg)
 
                 #self.trial_log['response_key'][self.phase].append(key)
                 #self.trial_log['response_onset'][self.phase].append(t)
@@ -237,36 +240,58 @@ class Trial:
 
         if self.eyetracker_on:  # Sets status message
             cmd = f"record_status_message 'trial {self.trial_nr}'"
-            self.session.tracker.sendCommand(cmd)
+            self.session.send_command(cmd)
 
         # Because the first flip happens when the experiment starts,
         # we need to compensate for this during the first trial/phase
         if self.session.first_trial:
             # must be first trial/phase
             if self.timing == 'seconds':  # subtract duration of one frame
-                self.phase_durations[0] -= 1./self.session.actual_framerate * 1.1  # +10% to be sure
+                self._phase_durations_arr[0] -= self.session._frame_period * 1.1  # +10% to be sure
             else:  # if timing == 'frames', subtract one frame 
-                self.phase_durations[0] -= 1
+                self._phase_durations_arr[0] -= 1
             
             self.session.first_trial = False
 
-        for phase_dur in self.phase_durations:  # loop over phase durations
+        # Look these up once, not on every frame
+        session = self.session
+        win, timer = session.win, session.timer
+        draw, get_events = self.draw, self.get_events
+        # Without a flip on every frame, frames cannot be counted
+        count_frames = self.draw_each_frame and session.settings.get(
+            'trial', {}).get('count_frames_seconds_timing', False)
+
+        for phase_dur in self._phase_durations_arr:  # loop over phase durations
             # pass self.phase *now* instead of while logging the phase info.
-            self.session.win.callOnFlip(self.log_phase_info, phase=self.phase)
+            win.callOnFlip(self.log_phase_info, phase=self.phase)
 
             # Start loading in next trial during this phase (if not None)
             if self.load_next_during_phase == self.phase:
                 self.load_next_trial(phase_dur)
 
-            if self.timing == 'seconds':
+            if self.timing == 'seconds' and count_frames:
+                # Convert the remaining phase time into frames once (this also
+                # corrects for any timing errors in earlier phases)
+                timer.add(phase_dur)
+                n_frames = max(0, round(-timer.getTime() / session._frame_period))
+                for _ in range(n_frames):
+
+                    if self.exit_phase or self.exit_trial:
+                        break
+
+                    draw()
+                    win.flip()
+                    session.nr_frames += 1
+                    get_events()
+            elif self.timing == 'seconds':
                 # Loop until timer is at 0!
-                self.session.timer.add(phase_dur)
-                while self.session.timer.getTime() < 0 and not self.exit_phase and not self.exit_trial:
-                    self.draw()
+                timer.add(phase_dur)
+                while timer.getTime() < 0 and not self.exit_phase and not self.exit_trial:
+                    draw()
                     if self.draw_each_frame:
-                        self.session.win.flip()
-                        self.session.nr_frames += 1
-                    self.get_events()
+                        win.flip()
+                        session.nr_frames += 1
+                    get_events()
             else:
                 # Loop for a predetermined number of frames
                 # Note: only works when you're sure you're not 
@@ -276,16 +301,16 @@ class Trial:
                     if self.exit_phase or self.exit_trial:
                         break
 
-                    self.draw()
-                    self.session.win.flip()
-                    self.get_events()
-                    self.session.nr_frames += 1
+                    draw()
+                    win.flip()
+                    get_events()
+                    session.nr_frames += 1
 
             if self.exit_phase:  # broke out of phase loop
-                self.session.timer.reset()  # reset timer!
+                timer.reset()  # reset timer!
                 self.exit_phase = False  # reset exit_phase
             if self.exit_trial:
-                self.session.timer.reset()
+                timer.reset()
                 break
 
             self.phase += 1  # advance phase
@@ -1,4 +1,6 @@
 import pickle
+import msgpack
+import msgpack_numpy
 
 
 def save_experiment(session, output_str, engine='pickle'):
@@ -11,11 +13,29 @@ def save_experiment(session, output_str, engine='pickle'):
     output_str : str
         name of output file (saves to current cwd) or complete filepath
     engine : str (default = 'pickle')
-        Select engine to save object, either 'pickle' or 'joblib'
+        Select engine to save object, either 'pickle' or 'msgpack'. The
+        latter only saves the trials' data (trial nr, phase durations,
+        parameters, and last response), not the full object; this is
+        much smaller and faster, and avoids pickling psychopy internals.
+        If the session keeps a list of the trials it ran (``trials_run``),
+        that list is saved instead of ``session.trials``, which may be a
+        one-shot iterator
     """
 
     if engine == 'pickle':
         with open(output_str + '.pkl', 'w') as f_out:
             pickle.dump(session, f_out)
+    elif engine == 'msgpack':
+        data = [
+            {'trial_nr': trial.trial_nr,
+             'start_trial': trial.start_trial,
+             'phase_durations': list(trial.phase_durations),
+             'parameters': trial.parameters,
+             'last_resp': trial.last_resp,
+             'last_resp_onset': trial.last_resp_onset}
+            for trial in getattr(session, 'trials_run', session.trials)
+        ]
+        with open(output_str + '.msgpack', 'wb') as f_out:
+            f_out.write(msgpack.packb(data, default=msgpack_numpy.encode))
     else:
-        raise ValueError("Engine not recognized, use 'pickle'")
+        raise ValueError("Engine not recognized, use 'pickle' or 'msgpack'")
@@ -55,9 +55,9 @@ VERSION = __version__
 PACKAGE_DATA = {'exptools2': [op.join('data', '*')]}
 PACKAGES = find_packages()
 REQUIRES = [
-    'psychopy>=3.0.4',
+    'psychopy>=3.1',
     'pyyaml',
-    'pandas>=0.23.0',
+    'pandas>=0.24.0',
     'numpy>=1.14.3',
     'msgpack_numpy'
 ]